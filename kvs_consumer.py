@@ -13,9 +13,11 @@ memory it may become large quickly, so instead chunking may be required
 """
 
 import io
-import wave
-import time
+import struct
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from amazon_kinesis_video_consumer_library.ebmlite import loadSchema
 from amazon_kinesis_video_consumer_library.kinesis_video_streams_parser import (
     KvsConsumerLibrary,
 )
@@ -26,12 +28,42 @@ from amazon_kinesis_video_consumer_library.kinesis_video_fragment_processor impo
 # Config the logger.
 log = logging.getLogger(__name__)
 
+# Audio format of the Connect KVS tracks. Used for WAV header construction
+AUDIO_SAMPLE_RATE = 8000
+AUDIO_SAMPLE_WIDTH = 2
+AUDIO_CHANNELS = 1
+
+# S3 multipart uploads require every part except the last to be at least 5MB
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Initial audio buffer allocation, roughly a 2 minute voicemail at
+# 8kHz/16-bit mono (16kB/s). Buffers double when this is exceeded
+AUDIO_BUFFER_INITIAL_SIZE = 2_000_000
+
+# Module level caches so warm Lambda containers skip the GetDataEndpoint
+# control-plane round trip and media client construction on repeat streams.
+# The endpoint is stable per stream/API for long periods so caching is safe;
+# worst case under concurrent misses is a redundant lookup, not wrong data
+_ENDPOINT_CACHE = {}
+_MEDIA_CLIENT_CACHE = {}
+
 class KvsPythonConsumerConnect:
     """
     Class for KVS Consumption for Connect data
     """
 
-    def __init__(self, boto_session, stream_name, start_fragment, end_fragment):
+    def __init__(
+        self,
+        boto_session,
+        stream_name,
+        start_fragment,
+        end_fragment,
+        s3_client=None,
+        s3_bucket=None,
+        s3_key=None,
+        parallel_track_extraction=False,
+        channels=("from", "to"),
+    ):
         """
         Initialize the KVS clients as needed. The KVS Comsumer Library intentionally
         the KVS clients or the various media API calls. These have individual authentication
@@ -41,32 +73,126 @@ class KvsPythonConsumerConnect:
         The KvsConsumerLibrary sits above these and parses responses from GetMedia and
         GetMediaForFragmentList into MKV fragments and provides convenience functions to further
         process, save and extract the data within each given frame.
+
+        When s3_client, s3_bucket and s3_key are all provided the FROM_CUSTOMER track is
+        streamed straight into an S3 multipart upload as fragments arrive, rather than
+        being accumulated in memory for the caller. This keeps peak memory at roughly one
+        S3 part regardless of call length, which addresses the large file concern noted
+        in the module docstring. When not provided the original in-memory behaviour is
+        retained and the caller reads from_customer_audio as before.
+
+        parallel_track_extraction overlaps the FROM_CUSTOMER and TO_CUSTOMER
+        extractions rather than running them back to back. An ebmlite DOM wraps a
+        single stream that every traversal seeks on, so the two walks cannot share
+        one document: the TO_CUSTOMER side re-parses the raw fragment bytes into
+        its own DOM on a worker thread while FROM_CUSTOMER walks the shared DOM on
+        the callback thread. That re-parse plus GIL contention between the mostly
+        pure-Python walks means this is off by default and only worth enabling
+        where profiling shows time in C calls that release the GIL.
+
+        channels selects which audio tracks are extracted ("from", "to" or both).
+        Callers that only consume one side of the call, such as the voicemail
+        handler which only uploads FROM_CUSTOMER, can disable the other track to
+        skip its DOM walk, buffering and WAV conversion entirely.
         """
 
         # Create shared instance of KvsFragementProcessor
         self.kvs_fragment_processor = KvsFragementProcessor()
 
+        # Init the KVS Service Client and get the accounts KVS service endpoint
+        log.info("Initializing Amazon Kinesis Video client....")
+        # Attach session specific configuration (such as the authentication pattern)
+        self.session = boto_session
+        self.kvs_client = self.session.client("kinesisvideo")
+        self._parallel_track_extraction = parallel_track_extraction
+        # Schema for re-parsing fragment bytes on the extraction worker;
+        # loadSchema caches, so this is a lookup after the first instance
+        self._mkv_schema = loadSchema("matroska.xml") if parallel_track_extraction else None
+
+        # All per-stream state lives in reset() so the (expensive) clients
+        # above can be reused across many streams on a warm container
+        self.reset(
+            stream_name,
+            start_fragment,
+            end_fragment,
+            s3_client=s3_client,
+            s3_bucket=s3_bucket,
+            s3_key=s3_key,
+            channels=channels,
+        )
+
+    def reset(
+        self,
+        stream_name,
+        start_fragment,
+        end_fragment,
+        s3_client=None,
+        s3_bucket=None,
+        s3_key=None,
+        channels=("from", "to"),
+    ):
+        """
+        Clear all per-stream state ready to process another stream with the
+        same instance. Constructing a fresh consumer per voicemail rebuilds
+        the kinesisvideo client each time; callers handling batches should
+        instead keep one instance (per thread, instances are not thread safe)
+        and reset it between records.
+        """
+
         # Variables initiated that move the state through
         self.stream_name = stream_name
         self.start_fragment = start_fragment
-        self.end_fragment = end_fragment
+        # Parsed to int once here so the per-fragment comparison in
+        # on_fragment_arrived does not re-parse an unchanging value
+        self.end_fragment = int(end_fragment)
 
         # Attributes used in processing
         self.last_good_fragment_tags = None
         self.past_end_fragment = False
         self.finished_audio_processing = False
-        self.from_audio_fragments = bytearray()
-        self.to_audio_fragments = bytearray()
+        # Event signalled once processing is fully complete, so that
+        # service_loop() wakes immediately rather than polling
+        self._processing_complete = threading.Event()
+        # Audio buffers are pre-sized and written through a cursor so appending
+        # a fragment is a single slice assignment; capacity doubles on overflow
+        # rather than reallocating on every extend. Disabled channels keep an
+        # empty buffer so downstream length checks behave as before
+        self.channels = channels
+        self.from_audio_fragments = (
+            bytearray(AUDIO_BUFFER_INITIAL_SIZE) if "from" in channels else bytearray()
+        )
+        self._from_audio_pos = 0
+        self.to_audio_fragments = (
+            bytearray(AUDIO_BUFFER_INITIAL_SIZE) if "to" in channels else bytearray()
+        )
+        self._to_audio_pos = 0
 
         # Final results we want to use elsewhere
         self.to_customer_audio = None
         self.from_customer_audio = None
 
-        # Init the KVS Service Client and get the accounts KVS service endpoint
-        log.info("Initializing Amazon Kinesis Video client....")
-        # Attach session specific configuration (such as the authentication pattern)
-        self.session = boto_session
-        self.kvs_client = self.session.client("kinesisvideo")
+        # Optional direct-to-S3 streaming of the FROM_CUSTOMER track. The multipart
+        # upload is created lazily on the first fragment containing audio so that
+        # empty streams never leave a dangling upload behind
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.streaming_to_s3 = all((s3_client, s3_bucket, s3_key))
+        self.uploaded_to_s3 = False
+        self._upload_id = None
+        self._upload_parts = []
+        self._part_number = 1
+        self._part_buffer = bytearray()
+        self._pcm_byte_count = 0
+
+        # Optional worker for extracting the TO_CUSTOMER track concurrently
+        # with the FROM_CUSTOMER walk on the callback thread. Recreated per
+        # stream as on_stream_read_complete shuts it down
+        self._extraction_pool = (
+            ThreadPoolExecutor(max_workers=1)
+            if self._parallel_track_extraction
+            else None
+        )
 
     ####################################################
     # Main process loop
@@ -86,13 +212,17 @@ class KvsPythonConsumerConnect:
         )
         get_media_endpoint = self._get_data_endpoint(self.stream_name, "GET_MEDIA")
 
-        # Get the KVS Media client for the GetMedia API call
-        log.info(
-            "Initializing KVS Media client for stream: %s........", self.stream_name
-        )
-        kvs_media_client = self.session.client(
-            "kinesis-video-media", endpoint_url=get_media_endpoint
-        )
+        # Get the KVS Media client for the GetMedia API call, reusing any client
+        # already built for this endpoint as construction itself is expensive
+        kvs_media_client = _MEDIA_CLIENT_CACHE.get(get_media_endpoint)
+        if kvs_media_client is None:
+            log.info(
+                "Initializing KVS Media client for stream: %s........", self.stream_name
+            )
+            kvs_media_client = self.session.client(
+                "kinesis-video-media", endpoint_url=get_media_endpoint
+            )
+            _MEDIA_CLIENT_CACHE[get_media_endpoint] = kvs_media_client
 
         # Make a KVS GetMedia API call with the desired KVS stream and
         # StartSelector type and time bounding.
@@ -123,15 +253,16 @@ class KvsPythonConsumerConnect:
         stream_consumer.start()
 
         # Here can hold the process up by waiting for the KvsConsumerLibrary thread to
-        # finish (may never finish for live streaming fragments)
-        while not self.finished_audio_processing:
-            time.sleep(1)
+        # finish (may never finish for live streaming fragments). The event is set by
+        # on_stream_read_complete() so we wake the instant processing finishes instead
+        # of polling, which matters for Lambda billed duration
+        self._processing_complete.wait()
 
         # stream_consumer.join()
-        # This would also be a valid block to wait until processing is completed, 
-        # however the while loop is provided to allow the ability to inject more context
-        # to logging/do extra work
-        
+        # This would also be a valid block to wait until processing is completed,
+        # however the event wait returns the moment the callback fires rather than
+        # waiting for the thread itself to be torn down
+
         log.info("Finished processing")
 
     ####################################################
@@ -197,23 +328,54 @@ class KvsPythonConsumerConnect:
                 self.last_good_fragment_tags["AWS_KINESISVIDEO_FRAGMENT_NUMBER"]
             )
 
-            if int(current_fragment) > int(self.end_fragment):
+            if current_fragment > self.end_fragment:
                 log.info("Pass final timestamp.")
                 self.past_end_fragment = True
             else:
-                # Checks for data in the FROM_CUSTOMER channel
-                from_data = self.kvs_fragment_processor.save_connect_fragment_audio_track_from_customer(
-                    fragment_dom
-                )
+                # Check for data in the enabled FROM_CUSTOMER / TO_CUSTOMER
+                # channels. The two extractions are independent, so when the
+                # extraction pool is enabled and both channels are wanted they
+                # are overlapped rather than run in series
+                extract_from = "from" in self.channels
+                extract_to = "to" in self.channels
+                from_data = None
+                to_data = None
+                if self._extraction_pool is not None and extract_from and extract_to:
+                    # The two walks must not share fragment_dom: an ebmlite
+                    # document reads values by seeking its single underlying
+                    # stream, so concurrent traversals would interleave
+                    # positions and corrupt both tracks. The worker re-parses
+                    # the raw bytes into its own DOM while this thread walks
+                    # the shared one
+                    to_future = self._extraction_pool.submit(
+                        self._extract_to_customer_from_bytes, fragment_bytes
+                    )
+                    from_data = self.kvs_fragment_processor.save_connect_fragment_audio_track_from_customer(
+                        fragment_dom
+                    )
+                    to_data = to_future.result()
+                else:
+                    if extract_from:
+                        from_data = self.kvs_fragment_processor.save_connect_fragment_audio_track_from_customer(
+                            fragment_dom
+                        )
+                    if extract_to:
+                        to_data = self.kvs_fragment_processor.save_connect_fragment_audio_track_to_customer(
+                            fragment_dom
+                        )
+
                 if from_data:
-                    self.from_audio_fragments.extend(from_data)
+                    if self.streaming_to_s3:
+                        self._stream_audio_to_s3(from_data)
+                    else:
+                        self._from_audio_pos = self._append_audio(
+                            self.from_audio_fragments, self._from_audio_pos, from_data
+                        )
 
-                # Checks for data in the TO_CUSTOMER channel
-                to_data = self.kvs_fragment_processor.save_connect_fragment_audio_track_to_customer(
-                    fragment_dom
-                )
                 if to_data:
-                    self.to_audio_fragments.extend(to_data)
+                    self._to_audio_pos = self._append_audio(
+                        self.to_audio_fragments, self._to_audio_pos, to_data
+                    )
 
         except Exception as err:
             log.error("on_fragment_arrived Error: %s", err)
@@ -233,24 +395,35 @@ class KvsPythonConsumerConnect:
         # This could instead be left as an activity for the caller, however in this case
         # we known exactly how this will be used
         try:
+            # Trim the pre-sized buffers down to the bytes actually written
+            del self.to_audio_fragments[self._to_audio_pos:]
+            del self.from_audio_fragments[self._from_audio_pos:]
+
             if len(self.to_audio_fragments) > 0:
                 self.to_customer_audio = self.convert_track_to_wav(
                     self.to_audio_fragments
                 )
 
-            if len(self.from_audio_fragments) > 0:
+            if self.streaming_to_s3:
+                self._complete_s3_upload()
+            elif len(self.from_audio_fragments) > 0:
                 self.from_customer_audio = self.convert_track_to_wav(
                     self.from_audio_fragments
                 )
 
         except Exception as exc:
             log.error(exc)
+            if self.streaming_to_s3:
+                self._abort_s3_upload()
         finally:
             log.info("Finished parsing audio fragments to file")
             # Ensure the end flag is appropriately set so that the service_loop()
             # exits cleanly and returns to the calling flow in synchronous usage,
             # or can be evaluated in async
             self.finished_audio_processing = True
+            if self._extraction_pool is not None:
+                self._extraction_pool.shutdown(wait=False)
+            self._processing_complete.set()
 
     def on_stream_read_exception(self, stream_name, error):
         """
@@ -290,28 +463,182 @@ class KvsPythonConsumerConnect:
             error,
         )
 
+    ####################################################
+    # Audio buffer helpers
+
+    def _extract_to_customer_from_bytes(self, fragment_bytes):
+        """
+        Parse a private DOM from the raw fragment bytes and extract the
+        TO_CUSTOMER track. Used by the parallel extraction path, where the
+        worker cannot safely walk the DOM being traversed on the callback
+        thread and so builds its own copy instead.
+        """
+        fragment_dom = self._mkv_schema.loads(fragment_bytes)
+        return self.kvs_fragment_processor.save_connect_fragment_audio_track_to_customer(
+            fragment_dom
+        )
+
+    @staticmethod
+    def _append_audio(buffer, position, data):
+        """
+        Write data into buffer at position, doubling the buffer capacity when
+        needed, and return the new write position. Keeps the number of
+        reallocations to O(log n) over the life of a stream rather than one
+        per fragment.
+        """
+        needed = position + len(data)
+        if needed > len(buffer):
+            buffer.extend(bytes(max(len(buffer), needed - len(buffer))))
+        buffer[position:needed] = data
+        return needed
+
+    ####################################################
+    # S3 streaming helpers
+
+    def _build_wav_header(self, data_size):
+        """
+        Build the 44 byte RIFF/WAVE header for the Connect PCM audio format.
+        When streaming and the final size is not yet known, data_size may be
+        0xFFFFFFFF (the conventional value for streamed WAV files, accepted by
+        most players and by transcription services).
+        """
+        riff_size = data_size if data_size == 0xFFFFFFFF else data_size + 36
+        byte_rate = AUDIO_SAMPLE_RATE * AUDIO_CHANNELS * AUDIO_SAMPLE_WIDTH
+        block_align = AUDIO_CHANNELS * AUDIO_SAMPLE_WIDTH
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF",
+            riff_size,
+            b"WAVE",
+            b"fmt ",
+            16,
+            1,  # PCM format
+            AUDIO_CHANNELS,
+            AUDIO_SAMPLE_RATE,
+            byte_rate,
+            block_align,
+            AUDIO_SAMPLE_WIDTH * 8,
+            b"data",
+            data_size,
+        )
+
+    def _stream_audio_to_s3(self, audio_bytes):
+        """
+        Append a fragments worth of PCM to the in-flight S3 multipart upload,
+        creating the upload and writing the WAV header on the first fragment.
+        Parts are only flushed once they reach the S3 minimum part size, so
+        short calls (the usual case) stay in a single buffered part which is
+        finalised with exact sizes in _complete_s3_upload().
+        """
+        if self._upload_id is None:
+            log.info(
+                "Starting S3 multipart upload to '%s/%s'", self.s3_bucket, self.s3_key
+            )
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.s3_bucket, Key=self.s3_key, ContentType="audio/x-wav"
+            )
+            self._upload_id = response["UploadId"]
+            # Placeholder sizes, patched before upload if the audio fits one part
+            self._part_buffer.extend(self._build_wav_header(0xFFFFFFFF))
+
+        self._part_buffer.extend(audio_bytes)
+        self._pcm_byte_count += len(audio_bytes)
+
+        if len(self._part_buffer) >= S3_MIN_PART_SIZE:
+            self._flush_s3_part()
+
+    def _flush_s3_part(self):
+        """
+        Upload the current part buffer as the next part of the multipart upload.
+        """
+        response = self.s3_client.upload_part(
+            Bucket=self.s3_bucket,
+            Key=self.s3_key,
+            PartNumber=self._part_number,
+            UploadId=self._upload_id,
+            Body=bytes(self._part_buffer),
+        )
+        self._upload_parts.append(
+            {"PartNumber": self._part_number, "ETag": response["ETag"]}
+        )
+        self._part_number += 1
+        self._part_buffer = bytearray()
+
+    def _complete_s3_upload(self):
+        """
+        Flush any remaining audio and complete the multipart upload. If all of
+        the audio is still buffered locally (calls shorter than the S3 minimum
+        part size, which covers several minutes of 8kHz PCM) the placeholder
+        WAV header is rewritten with the exact sizes before the single part is
+        sent. If no audio arrived at all, no upload was ever created.
+        """
+        if self._upload_id is None:
+            log.info("No FROM_CUSTOMER audio received, nothing to upload")
+            return
+
+        if not self._upload_parts:
+            # Everything fits in one part - patch the header in place
+            self._part_buffer[:44] = self._build_wav_header(self._pcm_byte_count)
+
+        if self._part_buffer:
+            self._flush_s3_part()
+
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.s3_bucket,
+            Key=self.s3_key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._upload_parts},
+        )
+        self.uploaded_to_s3 = True
+        log.info(
+            "Completed S3 multipart upload of %i PCM bytes to '%s/%s'",
+            self._pcm_byte_count,
+            self.s3_bucket,
+            self.s3_key,
+        )
+
+    def _abort_s3_upload(self):
+        """
+        Abort an in-flight multipart upload so S3 does not retain (and bill for)
+        orphaned parts after a processing failure.
+        """
+        if self._upload_id is None or self.uploaded_to_s3:
+            return
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.s3_bucket, Key=self.s3_key, UploadId=self._upload_id
+            )
+        except Exception as exc:
+            log.error("Failed to abort multipart upload: %s", exc)
+
     ####################################################
     # KVS Helpers
     def _get_data_endpoint(self, stream_name, api_name):
         """
         Convenience method to get the KVS client endpoint for specific API calls.
+        Cached per (stream, API) so repeat voicemails on a warm container skip
+        the control-plane round trip.
         """
-        response = self.kvs_client.get_data_endpoint(
-            StreamName=stream_name, APIName=api_name
-        )
-        return response["DataEndpoint"]
+        endpoint = _ENDPOINT_CACHE.get((stream_name, api_name))
+        if endpoint is None:
+            response = self.kvs_client.get_data_endpoint(
+                StreamName=stream_name, APIName=api_name
+            )
+            endpoint = response["DataEndpoint"]
+            _ENDPOINT_CACHE[(stream_name, api_name)] = endpoint
+        return endpoint
 
     def convert_track_to_wav(self, track_bytearray):
         """
-        This function converts a track bytearray to a wav file.
+        This function converts a track bytearray to a wav file. The 44 byte
+        header is built directly (see _build_wav_header) rather than going
+        through the wave module, so the PCM is written into the BytesIO
+        exactly once with no intermediate copies.
         """
 
         file_wav = io.BytesIO()
-        with wave.open(file_wav, "wb") as f:
-            f.setnchannels(1)
-            f.setframerate(8000)
-            f.setsampwidth(2)
-            f.writeframes(track_bytearray)
+        file_wav.write(self._build_wav_header(len(track_bytearray)))
+        file_wav.write(track_bytearray)
         return file_wav
 
     def save_connect_fragment_audio_track_as_wav(self, byte_array, file_name_path):
@@ -10,12 +10,25 @@ import os
 import base64
 import json
 import logging
-from datetime import datetime
-from zoneinfo import ZoneInfo
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from urllib.parse import urlencode
 
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 
-from kvs_consumer import KvsPythonConsumerConnect
+# orjson parses typical Connect payloads 2-3x faster than the stdlib, which
+# adds up over large Kinesis batches, but it is an optional extra: fall back
+# to json.loads when the package is not bundled with the function
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# KvsPythonConsumerConnect is imported lazily in _get_processor: it pulls in
+# the whole KVS consumer library and ebmlite, which is wasted cold-start time
+# for invocations whose batch holds no actual voicemails
 
 log = logging.getLogger()
 # logging.basicConfig(
@@ -35,6 +48,233 @@ BUCKET_NAME = os.environ["S3_VOICEMAIL_BUCKET"]
 RECORDING_PATH = os.getenv("S3_RECORDING_PATH", "")
 AUDIO_MIME_TYPE = "audio/x-wav"
 
+# One transfer manager shared across records and warm invocations, so the
+# manager's worker threads and multipart machinery are built once rather
+# than per upload. Voicemail WAVs are a few MB at most, so the raised
+# multipart threshold means every recording goes up as one request on the
+# shared connection pool, and a handful of workers drain the uploads in
+# the background while record workers move on to the next KVS stream
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024, max_concurrency=4
+)
+_TRANSFER_MANAGER = create_transfer_manager(S3_CLIENT, _TRANSFER_CONFIG)
+
+# Upper bound on concurrently processed Kinesis records. Each record is
+# dominated by network waits (KVS GetMedia streaming and the S3 put) so
+# threads overlap well, but we bound the fan-out to stay within Lambda
+# vCPU and downstream API limits
+MAX_RECORD_WORKERS = 8
+
+# Pool that fans records out across worker threads. Module-level so the
+# threads - and the thread-local consumers bound to them - survive across
+# warm invocations instead of being torn down and rebuilt per batch
+_RECORD_POOL = ThreadPoolExecutor(max_workers=MAX_RECORD_WORKERS)
+
+# One KVS consumer per record worker thread, reset between records rather
+# than rebuilt, as constructing the consumer means constructing a boto3
+# kinesisvideo client. Thread-local because consumer instances hold
+# per-stream state and are not thread safe
+_THREAD_LOCAL = threading.local()
+
+
+def _get_processor(stream_name, fragment_start, fragment_stop):
+    """
+    Return this thread's KVS consumer, reset for the given stream bounds,
+    creating it on first use. Only the FROM_CUSTOMER track is requested as
+    that is all the voicemail flow uploads.
+    """
+    # Deferred so the consumer library import chain is only paid on the first
+    # record that actually needs processing; sys.modules makes repeats free
+    from kvs_consumer import KvsPythonConsumerConnect
+
+    processor = getattr(_THREAD_LOCAL, "processor", None)
+    if processor is None:
+        # Each worker thread gets its own Session: boto3 clients are thread
+        # safe but Sessions are not, and concurrent client creation against
+        # a shared Session races in botocore's loader/endpoint resolution.
+        # The Session lives on through the processor for the thread's lifetime
+        processor = KvsPythonConsumerConnect(
+            boto_session=boto3.Session(region_name=AWS_REGION),
+            stream_name=stream_name,
+            start_fragment=fragment_start,
+            end_fragment=fragment_stop,
+            channels=("from",),
+        )
+        _THREAD_LOCAL.processor = processor
+    else:
+        processor.reset(
+            stream_name, fragment_start, fragment_stop, channels=("from",)
+        )
+    return processor
+
+
+def _process_record(record, record_number, s3_base_path):
+    """
+    Process a single Kinesis record through to the S3 upload. Runs on a worker
+    thread, so it touches no shared mutable state and reports back through its
+    return value.
+
+    Input:
+    ---------------
+        record: dict - A single entry from the Kinesis event "Records" list.
+        record_number: int - 1-based position of the record in the batch, used
+            for logging and the error entries.
+        s3_base_path: str - Dated S3 prefix computed once per batch, to which
+            the contact ID and extension are appended.
+
+    Returns:
+    ---------------
+        (processed, error, upload): Tuple of a bool indicating the record was
+            handled to completion (including deliberate ignores), an error
+            dict for the response (or None - successes and ignores are only
+            logged, keeping the response O(failures)), and either None or a
+            (future, failure_error) pair for an S3 upload still in flight.
+            When upload is present the caller decides the record's outcome
+            from the future rather than the first two values.
+    """
+
+    # Extract the record data. Both loaders accept bytes directly, so the
+    # decoded payload goes straight in without an intermediate str copy
+    try:
+        vm_record = _json_loads(base64.b64decode(record["kinesis"]["data"]))
+        current_contact_id = vm_record["ContactId"]
+        # Bound once here; the flag evaluation and tag builder below both
+        # read from this rather than re-fetching from vm_record
+        attribute_data = vm_record.get("Attributes") or {}
+    except Exception as exc:
+        log.error(exc)
+        return False, {
+            "record": record_number,
+            "error": "Failed to extract record and/or decode",
+        }, None
+
+    # Evaluate the VM recording flag
+    try:
+        vm_flag = attribute_data.get("vm_flag", "99")
+
+        if vm_flag == "1":
+            log.info(
+                "Record #%i ContactID: %s - is a voicemail - begin processing",
+                record_number,
+                current_contact_id,
+            )
+        elif vm_flag == "0":
+            log.info(
+                "ContactID: %s - IGNORE - voicemail already processed",
+                current_contact_id,
+            )
+            return True, None, None
+        else:
+            log.info(
+                "ContactID: %s - IGNORE - voicemail flag not valid",
+                current_contact_id,
+            )
+            return True, None, None
+    except Exception as exc:
+        log.error(exc)
+        return False, {
+            "record": record_number,
+            "contactId": current_contact_id,
+            "error": "An error occurred whilst evaluating Voicemail Flag",
+        }, None
+
+    # Extract the relevant KVS details for retrival
+    try:
+        stream_arn = vm_record["Recordings"][0]["Location"]
+        # The ARN ends with .../stream-name/creation-timestamp, so a single
+        # rsplit yields the name and raises on malformed ARNs rather than
+        # silently slicing the wrong section
+        _, stream_name, _ = stream_arn.rsplit("/", 2)
+        # Large value int. Trying to use float returns a scientific notation number
+        fragment_start = int(vm_record["Recordings"][0]["FragmentStartNumber"])
+        fragment_stop = int(vm_record["Recordings"][0]["FragmentStopNumber"])
+    except Exception as exc:
+        log.error(exc)
+        return False, {
+            "record": record_number,
+            "contactId": current_contact_id,
+            "error": "Failed to extract KVS info",
+        }, None
+
+    # Prep the tagging data for the S3 Object write. urlencode handles the
+    # separators and percent-encodes values, so tags containing characters
+    # such as & or = cannot corrupt the tag set
+    attribute_tag_container = ""
+    try:
+        attribute_tag_container = urlencode(
+            {
+                key: value
+                for key, value in attribute_data.items()
+                if key.startswith(("vm_lang", "vm_queue_arn"))
+            }
+        )
+    except Exception as exc:
+        log.error(exc)
+        return False, {
+            "record": record_number,
+            "contactId": current_contact_id,
+            "error": "Failed to extract vm tags",
+        }, None
+
+    log.info(
+        "Attempting to process '%s' in stream '%s'", current_contact_id, stream_name
+    )
+    # Action the recording processing and subsequent upload
+    try:
+        processor = _get_processor(stream_name, fragment_start, fragment_stop)
+
+        # Start the processing, waiting for completion of the activity
+        processor.service_loop()
+
+        # Grab the processed wav. Streams with no customer audio leave this
+        # unset, so short-circuit rather than failing at the S3 put
+        audio_file = processor.from_customer_audio
+        if audio_file is None:
+            log.info(
+                "ContactID: %s - no customer audio found in stream '%s'",
+                current_contact_id,
+                stream_name,
+            )
+            return True, None, None
+
+        s3_path = s3_base_path + current_contact_id + ".wav"
+
+        log.info("Storing recording at '%s' in bucket '%s'", s3_path, BUCKET_NAME)
+        # Hand the S3 Put to the transfer manager so this worker is free to
+        # start the next record's KVS retrieval while the upload drains on
+        # the manager's own threads. We don't use the result, simply want
+        # the outcome positive or negative, and lambda_handler resolves that
+        # from the future. The BytesIO is passed as-is rather than via
+        # getvalue(), which would clone the whole WAV into a bytes object at
+        # the peak-memory moment; it is owned solely by the upload from here
+        # on, so rewinding and handing it off is safe
+        audio_file.seek(0)
+        upload_future = _TRANSFER_MANAGER.upload(
+            audio_file,
+            BUCKET_NAME,
+            s3_path,
+            extra_args={
+                "ContentType": AUDIO_MIME_TYPE,
+                "Tagging": attribute_tag_container,
+            },
+        )
+
+        return True, None, (
+            upload_future,
+            {
+                "record": record_number,
+                "contactId": current_contact_id,
+                "error": "Failed to write audio to S3",
+            },
+        )
+    except Exception as exc:
+        log.error(exc)
+        return False, {
+            "record": record_number,
+            "contactId": current_contact_id,
+            "error": "Failed to write audio to S3",
+        }, None
+
 
 def lambda_handler(event, context):
     """
@@ -43,6 +283,9 @@ def lambda_handler(event, context):
     will be delivered, so we need to ensure we process and filter. An alternate approach
     would be to setup a filter on the Kinesis side looking for Attribute `vm_flag` == 1.
 
+    Records are fanned out across a bounded thread pool as each one is
+    independent and spends most of its time waiting on KVS and S3.
+
     Input:
     ---------------
         event: Kinesis Stream Records - The standard Kinesis record delivered into AWS Lambda
@@ -54,141 +297,54 @@ def lambda_handler(event, context):
     """
 
     log.info(event)
-    response_container = {}
+    # Only failures are reported back; successes and deliberate ignores are
+    # logged and counted, keeping the response O(failures) rather than
+    # O(records) for large batches
+    errors = []
 
-    total_record_count = 0
+    records = event["Records"]
+    total_record_count = len(records)
     processed_record_count = 0
 
-    for record in event["Records"]:
-        total_record_count += 1
-
-        # Extract the record data
-        try:
-            payload = base64.b64decode(record["kinesis"]["data"]).decode("utf-8")
-            vm_record = json.loads(payload)
-            current_contact_id = vm_record["ContactId"]
-        except Exception as exc:
-            log.error(exc)
-            response_container[f"Record #{total_record_count} result"] = (
-                "Failed to extract record and/or decode"
-            )
-            continue
-
-        # Evaluate the VM recording flag
-        try:
-            vm_flag = vm_record["Attributes"].get("vm_flag", "99")
-
-            if vm_flag == "1":
-                log.info(
-                    "Record #%i ContactID: %s - is a voicemail - begin processing",
-                    total_record_count,
-                    current_contact_id,
-                )
-            elif vm_flag == "0":
-                response_container[f"Record #{total_record_count} result"] = (
-                    f"ContactID: {current_contact_id} - IGNORE - voicemail already processed"
-                )
-                processed_record_count += 1
-                continue
-            else:
-                response_container[f"Record #{total_record_count} result"] = (
-                    f"ContactID: {current_contact_id} - IGNORE - voicemail flag not valid"
-                )
-                processed_record_count += 1
-                continue
-        except Exception as exc:
-            log.error(exc)
-            response_container[f"Record #{total_record_count} result"] = (
-                f"ContactID: {current_contact_id} - IGNORE - An error occurred "
-                "whilst evaluating Voicemail Flag"
-            )
-            continue
-
-        # Extract the relevant KVS details for retrival
-        try:
-            stream_arn = vm_record["Recordings"][0]["Location"]
-            stream_name = stream_arn[stream_arn.index("/") + 1 : stream_arn.rindex("/")]
-            # Large value int. Trying to use float returns a scientific notation number
-            fragment_start = int(vm_record["Recordings"][0]["FragmentStartNumber"])
-            fragment_stop = int(vm_record["Recordings"][0]["FragmentStopNumber"])
-        except Exception as exc:
-            log.error(exc)
-            response_container[f"Record #{total_record_count} result"] = (
-                "Failed to extract KVS info"
-            )
-            continue
+    # Generate the basepath in S3 once for the batch. All records share the
+    # same processing timestamp so there is no need to re-evaluate the date
+    # per record
+    date = datetime.now(timezone.utc)
+    s3_base_path = f"{RECORDING_PATH}{date:%Y/%m/%d}/"
 
-        # Prep the tagging data for the S3 Object write
-        attribute_data = {}
-        attribute_tag_container = ""
-        try:
-            attribute_data = vm_record.get("Attributes", {})
-            for key, value in attribute_data.items():
-                if key.startswith(tuple(["vm_lang", "vm_queue_arn"])):
-                    attribute_tag_container += f"{key}={value}&"
-            # Remove the trailing & symbol
-            attribute_tag_container.rstrip("&")
-        except Exception as exc:
-            log.error(exc)
-            response_container[f"Record #{total_record_count} result"] = (
-                "Failed to extract vm tags"
-            )
+    futures = {
+        _RECORD_POOL.submit(
+            _process_record, record, record_number, s3_base_path
+        ): record_number
+        for record_number, record in enumerate(records, 1)
+    }
+    pending_uploads = []
+    for future in as_completed(futures):
+        processed, error, upload = future.result()
+        if upload is not None:
+            # Outcome is decided by the upload future, joined below
+            pending_uploads.append(upload)
             continue
+        if processed:
+            processed_record_count += 1
+        if error is not None:
+            errors.append(error)
 
-        log.info(
-            "Attempting to process '%s' in stream '%s'", current_contact_id, stream_name
-        )
-        # Action the recording processing and subsequent upload
+    # Join the uploads the record workers left in flight. By now the KVS work
+    # is all done, so this only waits out the tail of the S3 transfers
+    for upload_future, failure_error in pending_uploads:
         try:
-            processor = KvsPythonConsumerConnect(
-                boto_session=SESSION,
-                stream_name=stream_name,
-                start_fragment=fragment_start,
-                end_fragment=fragment_stop,
-            )
-
-            # Start the processing, waiting for completion of the activity
-            processor.service_loop()
-
-            # Grab the processed wav
-            audio_file = processor.from_customer_audio
-
-            # Generate the basepath in S3 using current information, accounting
-            # for potential hour rollovers
-            date = datetime.now(tz=ZoneInfo("UTC"))
-            year = date.strftime("%Y")
-            month = date.strftime("%m")
-            day = date.strftime("%d")
-            s3_base_path = f"{RECORDING_PATH}{year}/{month}/{day}/"
-
-            s3_path = s3_base_path + current_contact_id + ".wav"
-
-            log.info("Storing recording at '%s' in bucket '%s'", s3_path, BUCKET_NAME)
-            # Create the S3 Put and complete it. We don't use the result,
-            # simply want the outcome positive or negative
-            put_response = S3_CLIENT.put_object(
-                Body=audio_file.getvalue(), # type: ignore
-                Bucket=BUCKET_NAME,
-                Key=s3_path,
-                ContentType=AUDIO_MIME_TYPE,
-                Tagging=attribute_tag_container,
-            )
-
-            log.debug(put_response)
-
+            log.debug(upload_future.result())
             processed_record_count += 1
         except Exception as exc:
             log.error(exc)
-            response_container[f"Record #{total_record_count} result"] = (
-                f"ContactID: {current_contact_id} - Failed to write audio to S3"
-            )
-            continue
+            errors.append(failure_error)
 
     response = {
         "statusCode": 200,
         "body": {
             "status": f"Complete. Processed {processed_record_count} of {total_record_count} records.",
-            "recordResults": response_container,
+            "errors": errors,
         },
     }
 